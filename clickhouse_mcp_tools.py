@@ -1,23 +1,107 @@
 #!/usr/bin/env pythonn
 
-import json
+import asyncio
 import logging
+import os
+import re
+import threading
+import time
+import uuid
 from typing import Dict, Any, Optional
+
+import orjson
+import urllib3
+from cachetools import TTLCache
 import clickhouse_connect
+from clickhouse_connect.driver import httputil
+
+logger = logging.getLogger(__name__)
+
+# Optional CA bundle for TLS verification against private certificate chains
+_CA_BUNDLE = os.getenv("CH_CA_BUNDLE")
+
+# Shared urllib3 pool manager so concurrent tool calls reuse warm TCP/TLS
+# connections instead of paying a handshake per query. get_pool_manager
+# applies its own socket options (SO_KEEPALIVE and TCP_NODELAY are already
+# in its defaults) and is the only place ca_cert takes effect for the sync
+# client, since get_client ignores TLS arguments when pool_mgr is supplied.
+_POOL_MGR = httputil.get_pool_manager(
+    maxsize=int(os.getenv("CH_POOL_MAXSIZE", "32")),
+    num_pools=int(os.getenv("CH_POOL_NUM", "4")),
+    block=False,
+    retries=urllib3.Retry(total=2, backoff_factor=0.1),
+    ca_cert=_CA_BUNDLE,
+)
+
+# Matches only the leading whitespace plus the first keyword, so the readonly
+# check costs the same for a 1 MB query as for a one-liner.
+_READONLY_SQL = re.compile(r'\s*(?:select|show|describe)\b', re.IGNORECASE)
+
+# Catalog metadata changes rarely but agents ask for it every turn; cache the
+# serialized responses briefly instead of round-tripping to ClickHouse.
+_META_CACHE = TTLCache(maxsize=512, ttl=int(os.getenv("CH_META_TTL", "60")))
+_META_LOCK = threading.Lock()
+
+# Server-side guards applied to every user query. LLM-generated SQL often
+# omits LIMIT; these cap the worst case without rewriting the statement.
+_QUERY_GUARDS = {
+    'max_result_rows': int(os.getenv("CH_MAX_ROWS", "100000")),
+    'max_bytes_to_read': int(os.getenv("CH_MAX_BYTES", str(10 * 1024 ** 3))),
+    'max_execution_time': int(os.getenv("CH_MAX_SECONDS", "60")),
+    'readonly': 1,
+}
+
+# Upper bound on sub-queries a single run_select_query call may fan out to
+_MAX_PARALLEL_QUERIES = int(os.getenv("CH_MAX_PARALLEL", "8"))
 
-# logger = logging.getLogger(_name_)
+# Pagination cursors for adaptive batched fetching; entries expire when a
+# client abandons its cursor.
+_CURSOR_CACHE = TTLCache(maxsize=256, ttl=int(os.getenv("CH_CURSOR_TTL", "300")))
+_CURSOR_LOCK = threading.Lock()
+
+# Pagination wraps the statement in a subquery, which only works for SELECT
+_SELECT_SQL = re.compile(r'\s*select\b', re.IGNORECASE)
+
+# Each page aims for this wall time; the batch size scales toward the budget
+_PAGE_TARGET_SECONDS = float(os.getenv("CH_PAGE_TARGET_SECONDS", "0.5"))
+_PAGE_MIN_ROWS = 100
+_PAGE_MAX_ROWS = 100_000
+
+
+def _classify_query_error(message: str) -> str:
+    """Map a ClickHouse error message onto a category agents can act on"""
+    if 'TOO_MANY_ROWS' in message or 'Code: 158' in message:
+        return 'row_limit_exceeded'
+    if 'TOO_MANY_BYTES' in message or 'Code: 307' in message:
+        return 'byte_limit_exceeded'
+    if 'TIMEOUT_EXCEEDED' in message or 'Code: 159' in message:
+        return 'timeout'
+    return 'query_error'
+
+
+def _dump(obj: Any) -> str:
+    """Serialize a tool response to compact JSON"""
+    return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
 
 
 class ClickHouseConnection:
     """Manages ClickHouse database connectionn"""
     
-    def __init__(self, host: str, username: str, password: str, port: int = 8123, secure: bool = False):
+    def __init__(self, host: str, username: str, password: str, port: int = 8123, secure: bool = False,
+                 compress: str = 'lz4'):
         self.host = host
         self.username = username
         self.password = password
         self.port = port
         self.secure = secure
+        self.compress = compress
         self._client = None
+        self._aclient = None
+        self._aclient_lock = asyncio.Lock()
+        # (checked_at, healthy) pair so health probes don't hit the server
+        # more than once per TTL window
+        self._last_health = (0.0, False)
+        self._health_ttl = float(os.getenv("CH_HEALTH_TTL", "5"))
     
     def get_client(self):
         """Get or create ClickHouse client"""
@@ -29,23 +113,61 @@ class ClickHouseConnection:
                     username=self.username,
                     password=self.password,
                     secure=self.secure,
-                    verify=False  # Set to True in production
+                    compress=self.compress,
+                    pool_mgr=_POOL_MGR,
+                    settings={'http_connection_timeout': 10}
                 )
                 logger.info(f"Connected to ClickHouse at {self.host}:{self.port}")
             except Exception as e:
                 logger.error(f"Failed to connect to ClickHouse: {e}")
                 raise
         return self._client
-    
+
+    async def get_async_client(self):
+        """Get or create async ClickHouse client for use inside the event loop"""
+        if self._aclient is None:
+            # Concurrent first calls (e.g. execute_many's gather) must not
+            # each create and leak their own client
+            async with self._aclient_lock:
+                if self._aclient is None:
+                    try:
+                        # The native async client manages its own aiohttp
+                        # connector and rejects pool_mgr; size its pool to
+                        # match the sync one instead
+                        pool_size = int(os.getenv("CH_POOL_MAXSIZE", "32"))
+                        self._aclient = await clickhouse_connect.get_async_client(
+                            host=self.host,
+                            port=self.port,
+                            username=self.username,
+                            password=self.password,
+                            secure=self.secure,
+                            compress=self.compress,
+                            connector_limit=pool_size,
+                            connector_limit_per_host=pool_size,
+                            ca_cert=_CA_BUNDLE,
+                            settings={'http_connection_timeout': 10}
+                        )
+                        logger.info(f"Connected to ClickHouse (async) at {self.host}:{self.port}")
+                    except Exception as e:
+                        logger.error(f"Failed to connect to ClickHouse: {e}")
+                        raise
+        return self._aclient
+
     def test_connection(self) -> bool:
-        """Test if connection is working"""
+        """Test if connection is working, reusing a recent result if available"""
+        now = time.monotonic()
+        checked_at, healthy = self._last_health
+        if now - checked_at < self._health_ttl:
+            return healthy
         try:
             client = self.get_client()
-            result = client.query("SELECT 1")
-            return True
+            client.query("SELECT 1")
+            healthy = True
         except Exception as e:
             logger.error(f"Connection test failed: {e}")
-            return False
+            healthy = False
+        self._last_health = (time.monotonic(), healthy)
+        return healthy
 
 
 class RunSelectQuery:
@@ -64,44 +186,202 @@ class RunSelectQuery:
                 "sql": {
                     "type": "string",
                     "description": "The SQL SELECT query to execute"
+                },
+                "sqls": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Independent SELECT queries to execute concurrently (alternative to sql)"
+                },
+                "format": {
+                    "type": "string",
+                    "enum": ["rows", "columnar"],
+                    "description": "Result layout: 'rows' (list of objects, default) or 'columnar' (one array per column)"
+                },
+                "paginate": {
+                    "type": "boolean",
+                    "description": "Return results one adaptively sized page at a time with a continuation cursor"
+                },
+                "cursor": {
+                    "type": "string",
+                    "description": "Continuation cursor from a previous paginated call"
                 }
             },
-            "required": ["sql"]
+            "required": []
         }
     
-    def execute(self, sql: str) -> str:
+    async def execute(self, sql: str, format: str = "rows") -> str:
         """Execute a SELECT query"""
         try:
+            if not sql:
+                return _dump({"error": "sql is required"})
             # Ensure query is readonly
-            sql_lower = sql.strip().lower()
-            if not sql_lower.startswith('select') and not sql_lower.startswith('show') and not sql_lower.startswith('describe'):
-                return json.dumps({
+            if not _READONLY_SQL.match(sql):
+                return _dump({
                     "error": "Only SELECT, SHOW, and DESCRIBE queries are allowed"
                 })
             
-            client = self.connection.get_client()
-            result = client.query(sql)
+            client = await self.connection.get_async_client()
+            result = await client.query(sql, settings=_QUERY_GUARDS)
             
-            # Convert result to list of dictionaries
             columns = result.column_names
-            rows = []
-            for row in result.result_rows:
-                rows.append(dict(zip(columns, row)))
-            
-            return json.dumps({
+            if format == "columnar":
+                return _dump({
+                    "success": True,
+                    "columns": columns,
+                    "data": [list(column) for column in result.result_columns],
+                    "row_count": result.row_count,
+                    "query": sql
+                })
+
+            # named_results() builds the row dicts in the driver, avoiding a
+            # Python-level zip/dict loop over every row
+            rows = list(result.named_results())
+
+            return _dump({
                 "success": True,
                 "columns": columns,
                 "rows": rows,
                 "row_count": len(rows),
                 "query": sql
-            }, indent=2, default=str)
+            })
             
         except Exception as e:
             logger.error(f"Query execution failed: {e}")
-            return json.dumps({
+            error_type = _classify_query_error(str(e))
+            response = {
                 "error": f"Query execution failed: {str(e)}",
+                "error_type": error_type,
                 "query": sql
+            }
+            if error_type in ('row_limit_exceeded', 'byte_limit_exceeded'):
+                response["hint"] = "Result exceeded the server-side cap; add a LIMIT clause or narrow the query"
+            elif error_type == 'timeout':
+                response["hint"] = "Query hit the execution time cap; narrow the query or retry with a LIMIT"
+            return _dump(response)
+
+    async def execute_paginated(self, sql: Optional[str] = None, cursor: Optional[str] = None,
+                                format: str = "rows") -> str:
+        """Fetch results one adaptively sized page at a time.
+
+        The first call runs the query with a small LIMIT and returns a cursor;
+        each follow-up call replays it at the next offset with the batch size
+        scaled toward the per-page time budget, doubling until a page takes
+        about that long. The cursor disappears once the result is exhausted.
+        """
+        if cursor is not None:
+            with _CURSOR_LOCK:
+                state = _CURSOR_CACHE.get(cursor)
+            if state is None:
+                return _dump({"error": "Unknown or expired cursor", "cursor": cursor})
+            query_id = cursor
+        else:
+            if not sql:
+                return _dump({"error": "sql is required"})
+            if not _SELECT_SQL.match(sql):
+                return _dump({
+                    "error": "Pagination is only supported for SELECT queries"
+                })
+            query_id = str(uuid.uuid4())
+            state = {'sql': sql.rstrip().rstrip(';'), 'offset': 0, 'limit': _PAGE_MIN_ROWS}
+
+        # Wrap rather than append so statements that already end in LIMIT,
+        # OFFSET, or a trailing comment still paginate correctly; the newline
+        # keeps a trailing line comment from swallowing the closing paren
+        paged_sql = f"SELECT * FROM (\n{state['sql']}\n) LIMIT {state['limit']} OFFSET {state['offset']}"
+        try:
+            client = await self.connection.get_async_client()
+            started = time.monotonic()
+            result = await client.query(paged_sql, settings=_QUERY_GUARDS)
+            elapsed = time.monotonic() - started
+        except Exception as e:
+            logger.error(f"Paginated query failed: {e}")
+            with _CURSOR_LOCK:
+                _CURSOR_CACHE.pop(query_id, None)
+            return _dump({
+                "error": f"Query execution failed: {str(e)}",
+                "error_type": _classify_query_error(str(e)),
+                "query": state['sql']
+            })
+
+        if format == "columnar":
+            data = [list(column) for column in result.result_columns]
+            row_count = len(data[0]) if data else 0
+        else:
+            rows = list(result.named_results())
+            row_count = len(rows)
+
+        if row_count < state['limit']:
+            # Result exhausted; drop the cursor
+            with _CURSOR_LOCK:
+                _CURSOR_CACHE.pop(query_id, None)
+            next_cursor = None
+        else:
+            scale = _PAGE_TARGET_SECONDS / elapsed if elapsed > 0 else 2.0
+            next_limit = int(min(max(state['limit'] * scale, _PAGE_MIN_ROWS), _PAGE_MAX_ROWS))
+            with _CURSOR_LOCK:
+                _CURSOR_CACHE[query_id] = {
+                    'sql': state['sql'],
+                    'offset': state['offset'] + row_count,
+                    'limit': next_limit,
+                }
+            next_cursor = query_id
+
+        response = {
+            "success": True,
+            "columns": result.column_names,
+            "row_count": row_count,
+            "offset": state['offset'],
+            "cursor": next_cursor,
+            "query": state['sql']
+        }
+        if format == "columnar":
+            response["data"] = data
+        else:
+            response["rows"] = rows
+        return _dump(response)
+
+    async def execute_many(self, sqls, format: str = "rows") -> str:
+        """Execute independent SELECT queries concurrently.
+
+        Each query runs through execute() with the same guards, so wall time
+        approaches the slowest sub-query instead of the sum of all of them.
+        """
+        if not isinstance(sqls, (list, tuple)) or not sqls:
+            return _dump({"error": "sqls must be a non-empty array of query strings"})
+        if len(sqls) > _MAX_PARALLEL_QUERIES:
+            return _dump({
+                "error": f"At most {_MAX_PARALLEL_QUERIES} queries may run concurrently"
             })
+        results = await asyncio.gather(*(self.execute(sql, format) for sql in sqls))
+        # Each result is already serialized JSON; join without re-encoding
+        return '[' + ','.join(results) + ']'
+
+    async def execute_stream(self, sql: str):
+        """Stream query results as NDJSON, one columnar block per line.
+
+        Blocks are serialized and yielded as ClickHouse delivers them, so the
+        full result set is never held in memory at once.
+        """
+        if not _READONLY_SQL.match(sql):
+            yield _dump({
+                "error": "Only SELECT, SHOW, and DESCRIBE queries are allowed"
+            }) + "\n"
+            return
+        try:
+            client = await self.connection.get_async_client()
+            stream_ctx = await client.query_column_block_stream(sql, settings=_QUERY_GUARDS)
+            with stream_ctx as stream:
+                yield _dump({"columns": stream_ctx.source.column_names}) + "\n"
+                # Blocks are fed by the event loop itself; iterating
+                # synchronously here would deadlock on large results
+                async for block in stream:
+                    yield _dump({"data": [list(column) for column in block]}) + "\n"
+        except Exception as e:
+            logger.error(f"Streaming query failed: {e}")
+            yield _dump({
+                "error": f"Streaming query failed: {str(e)}",
+                "query": sql
+            }) + "\n"
 
 
 class ListDatabases:
@@ -112,23 +392,31 @@ class ListDatabases:
         self.description = "List all databases available in the ClickHouse cluster"
         self.connection = connection
     
-    def execute(self) -> str:
+    async def execute(self) -> str:
         """List all databases"""
+        cache_key = (self.name,)
+        with _META_LOCK:
+            cached = _META_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
         try:
-            client = self.connection.get_client()
-            result = client.query("SHOW DATABASES")
+            client = await self.connection.get_async_client()
+            result = await client.query("SHOW DATABASES")
             
             databases = [row[0] for row in result.result_rows]
             
-            return json.dumps({
+            response = _dump({
                 "success": True,
                 "databases": databases,
                 "count": len(databases)
-            }, indent=2)
+            })
+            with _META_LOCK:
+                _META_CACHE[cache_key] = response
+            return response
             
         except Exception as e:
             logger.error(f"Failed to list databases: {e}")
-            return json.dumps({
+            return _dump({
                 "error": f"Failed to list databases: {str(e)}"
             })
 
@@ -154,24 +442,35 @@ class ListTables:
             "required": ["database"]
         }
     
-    def execute(self, database: str) -> str:
+    async def execute(self, database: str) -> str:
         """List tables in a databases"""
+        cache_key = (self.name, database)
+        with _META_LOCK:
+            cached = _META_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
         try:
-            client = self.connection.get_client()
-            result = client.query(f"SHOW TABLES FROM {database}")
+            client = await self.connection.get_async_client()
+            result = await client.query(
+                "SELECT name FROM system.tables WHERE database = {db:String} ORDER BY name",
+                parameters={'db': database}
+            )
             
             tables = [row[0] for row in result.result_rows]
             
-            return json.dumps({
+            response = _dump({
                 "success": True,
                 "database": database,
                 "tables": tables,
                 "count": len(tables)
-            }, indent=2)
+            })
+            with _META_LOCK:
+                _META_CACHE[cache_key] = response
+            return response
             
         except Exception as e:
             logger.error(f"Failed to list tables: {e}")
-            return json.dumps({
+            return _dump({
                 "error": f"Failed to list tables: {str(e)}",
                 "database": database
             })
@@ -182,7 +481,8 @@ class DescribeTable:
     
     def __init__(self, connection: ClickHouseConnection):
         self.name = "describe_table"
-        self.description = "Get the structure/schema of a specific table"
+        self.description = ("Get the structure/schema of a specific table. "
+                            "Returns a columns header plus one row per table column.")
         self.connection = connection
     
     def get_input_schema(self) -> Dict[str, Any]:
@@ -202,27 +502,48 @@ class DescribeTable:
             "required": ["database", "table"]
         }
     
-    def execute(self, database: str, table: str) -> str:
+    async def execute(self, database: str, table: str) -> str:
         """Describe table structure"""
+        cache_key = (self.name, database, table)
+        with _META_LOCK:
+            cached = _META_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
         try:
-            client = self.connection.get_client()
-            result = client.query(f"DESCRIBE TABLE {database}.{table}")
-            
-            columns = result.column_names
-            schema = []
-            for row in result.result_rows:
-                schema.append(dict(zip(columns, row)))
-            
-            return json.dumps({
+            client = await self.connection.get_async_client()
+            result = await client.query(
+                "SELECT name, type, default_kind, default_expression, comment "
+                "FROM system.columns WHERE database = {db:String} AND table = {t:String} "
+                "ORDER BY position",
+                parameters={'db': database, 't': table}
+            )
+
+            # system.columns returns an empty set for unknown tables, unlike
+            # DESCRIBE TABLE which raised; surface (and never cache) an error
+            # so agents can tell a missing table from a real schema
+            if not result.result_rows:
+                return _dump({
+                    "error": f"Table {database}.{table} does not exist",
+                    "database": database,
+                    "table": table
+                })
+
+            # Columnar layout: one header plus one value tuple per table
+            # column, instead of N dicts repeating the same five keys
+            response = _dump({
                 "success": True,
                 "database": database,
                 "table": table,
-                "schema": schema
-            }, indent=2, default=str)
+                "columns": result.column_names,
+                "rows": [list(row) for row in result.result_rows]
+            })
+            with _META_LOCK:
+                _META_CACHE[cache_key] = response
+            return response
             
         except Exception as e:
             logger.error(f"Failed to describe table: {e}")
-            return json.dumps({
+            return _dump({
                 "error": f"Failed to describe table: {str(e)}",
                 "database": database,
                 "table": table
@@ -232,12 +553,27 @@ class DescribeTable:
 class ClickHouseToolHandler:
     """Handler for ClickHouse MCP tools"""
     
-    def __init__(self, host: str, username: str, password: str, port: int = 8123, secure: bool = False):
-        self.connection = ClickHouseConnection(host, username, password, port, secure)
+    def __init__(self, host: str, username: str, password: str, port: int = 8123, secure: bool = False,
+                 compress: str = 'lz4'):
+        self.connection = ClickHouseConnection(host, username, password, port, secure, compress)
         self.run_query = RunSelectQuery(self.connection)
         self.list_databases = ListDatabases(self.connection)
         self.list_tables = ListTables(self.connection)
         self.describe_table = DescribeTable(self.connection)
+        # Dispatch table built once so call_tool is a single dict lookup on
+        # the tools/call hot path instead of a chain of string compares
+        self._dispatch = {
+            self.run_query.name: lambda **kw: (
+                self.run_query.execute_many(kw['sqls'], kw.get('format', 'rows'))
+                if kw.get('sqls') is not None
+                else self.run_query.execute_paginated(kw.get('sql'), kw.get('cursor'), kw.get('format', 'rows'))
+                if kw.get('cursor') is not None or kw.get('paginate')
+                else self.run_query.execute(kw.get('sql'), kw.get('format', 'rows'))
+            ),
+            self.list_databases.name: lambda **kw: self.list_databases.execute(),
+            self.list_tables.name: lambda **kw: self.list_tables.execute(kw.get('database')),
+            self.describe_table.name: lambda **kw: self.describe_table.execute(kw.get('database'), kw.get('table')),
+        }
     
     def test_connection(self) -> bool:
         """Test database connection"""
@@ -264,19 +600,9 @@ class ClickHouseToolHandler:
             }
         }
     
-    def call_tool(self, name: str, **kwargs) -> str:
+    async def call_tool(self, name: str, **kwargs) -> str:
         """Call a tool by name with parameters"""
-        if name == self.run_query.name:
-            sql = kwargs.get('sql')
-            return self.run_query.execute(sql)
-        elif name == self.list_databases.name:
-            return self.list_databases.execute()
-        elif name == self.list_tables.name:
-            database = kwargs.get('database')
-            return self.list_tables.execute(database)
-        elif name == self.describe_table.name:
-            database = kwargs.get('database')
-            table = kwargs.get('table')
-            return self.describe_table.execute(database, table)
-        else:
-            return json.dumps({"error": f"Unknown tool: {name}"})
+        tool_fn = self._dispatch.get(name)
+        if tool_fn is None:
+            return _dump({"error": f"Unknown tool: {name}"})
+        return await tool_fn(**kwargs)
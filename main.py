@@ -6,16 +6,17 @@ ClickHouse MCP Server - Main Application
 
 import asyncio
 import datetime
-import json
 import logging
 import os
 import uuid
+
+import orjson
 from typing import Dict, Any, Optional
 from dataclasses import dataclass
 
 # FastAPI imports
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
@@ -36,11 +37,12 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 # Configuration from environment
-# CLICKHOUSE_HOST = os.getenv("CLICKHOUSE_HOST", "172.16.3.6")
-# CLICKHOUSE_PORT = int(os.getenv("CLICKHOUSE_PORT", "8123"))
-# CLICKHOUSE_USER = os.getenv("CLICKHOUSE_USER", "devadmin")
-# CLICKHOUSE_PASSWORD = os.getenv("CLICKHOUSE_PASSWORD", "Dev12837sadqdk")
-# CLICKHOUSE_SECURE = os.getenv("CLICKHOUSE_SECURE", "false").lower() == "true"
+CLICKHOUSE_HOST = os.getenv("CLICKHOUSE_HOST", "localhost")
+CLICKHOUSE_PORT = int(os.getenv("CLICKHOUSE_PORT", "8123"))
+CLICKHOUSE_USER = os.getenv("CLICKHOUSE_USER", "default")
+CLICKHOUSE_PASSWORD = os.getenv("CLICKHOUSE_PASSWORD", "")
+CLICKHOUSE_SECURE = os.getenv("CLICKHOUSE_SECURE", "false").lower() == "true"
+CLICKHOUSE_COMPRESS = os.getenv("CLICKHOUSE_COMPRESS", "lz4")
 
 API_BASE_PATH = os.getenv("API_BASE_PATH", "/clickhouse")
 PORT = int(os.getenv("PORT", "8200"))
@@ -65,9 +67,35 @@ class SchemaManager:
             "properties": {},
             "required": []
         }
-    
+        self._tool_instances = {
+            "run_select_query": tool_handler.run_query,
+            "list_databases": tool_handler.list_databases,
+            "list_tables": tool_handler.list_tables,
+            "describe_table": tool_handler.describe_table,
+        }
+        # Per-tool schema dicts and required-parameter tuples, built once at
+        # startup so later lookups are plain dict indexes
+        self._schemas: Dict[str, Dict[str, Any]] = {}
+        self._required: Dict[str, tuple] = {}
+        for tool_name, tool_info in tool_handler.get_available_tools().items():
+            schema = self._build_tool_schema(tool_name, tool_info)
+            self._schemas[tool_name] = schema
+            self._required[tool_name] = tuple(schema["inputSchema"].get("required", []))
+        self._tools_list_cached = list(self._schemas.values())
+
+    def get_tools_list(self) -> list:
+        """Get the tools/list payload built once at startup"""
+        return self._tools_list_cached
+
     def get_tool_schema(self, tool_name: str, tool_info: Dict[str, Any]) -> Dict[str, Any]:
         """Get schema for a tool - either custom or default"""
+        schema = self._schemas.get(tool_name)
+        if schema is not None:
+            return schema
+        return self._build_tool_schema(tool_name, tool_info)
+
+    def _build_tool_schema(self, tool_name: str, tool_info: Dict[str, Any]) -> Dict[str, Any]:
+        """Construct the schema dict for a tool - either custom or default"""
         tool_instance = self._get_tool_instance(tool_name)
         if tool_instance and hasattr(tool_instance, 'get_input_schema'):
             custom_schema = tool_instance.get_input_schema()
@@ -86,18 +114,11 @@ class SchemaManager:
     
     def get_tool_required_params(self, tool_name: str) -> list:
         """Get required parameters for a tool"""
-        tool_instance = self._get_tool_instance(tool_name)
-        if tool_instance and hasattr(tool_instance, 'get_input_schema'):
-            custom_schema = tool_instance.get_input_schema()
-            if custom_schema:
-                return custom_schema.get("required", [])
-        return []
+        return list(self._required.get(tool_name, ()))
     
     def validate_tool_params(self, tool_name: str, arguments: Dict[str, Any]) -> Optional[str]:
         """Validate tool parameters and return error message if invalid"""
-        required_params = self.get_tool_required_params(tool_name)
-        
-        for param in required_params:
+        for param in self._required.get(tool_name, ()):
             if param not in arguments:
                 return f"{param} is required for {tool_name}"
         
@@ -105,27 +126,15 @@ class SchemaManager:
     
     def _get_tool_instance(self, tool_name: str):
         """Get tool instance by name"""
-        tool_mapping = {
-            "run_select_query": self.tool_handler.run_query,
-            "list_databases": self.tool_handler.list_databases,
-            "list_tables": self.tool_handler.list_tables,
-            "describe_table": self.tool_handler.describe_table,
-        }
-        return tool_mapping.get(tool_name)
+        return self._tool_instances.get(tool_name)
 
 
 class SSEHandler:
     """Handles SSE (Server-Sent Events) connections and MCP protocol"""
     
-    def __init__(self):
-        self.tool_handler = ClickHouseToolHandler(
-            host=CLICKHOUSE_HOST,
-            username=CLICKHOUSE_USER,
-            password=CLICKHOUSE_PASSWORD,
-            port=CLICKHOUSE_PORT,
-            secure=CLICKHOUSE_SECURE
-        )
-        self.schema_manager = SchemaManager(self.tool_handler)
+    def __init__(self, tool_handler: ClickHouseToolHandler, schema_manager: SchemaManager):
+        self.tool_handler = tool_handler
+        self.schema_manager = schema_manager
         self.mcp = FastMCP(name="ClickHouse_MCP_Server")
         self.sse_transport = SseServerTransport("/messages/")
         self._register_mcp_tools()
@@ -141,37 +150,41 @@ class SSEHandler:
             def create_tool_function(name, schema, info):
                 if name == "run_select_query":
                     @self.mcp.tool(name=name, description=info["description"])
-                    def run_query_tool(sql: str) -> str:
+                    async def run_query_tool(sql: str = "", format: str = "rows", sqls: Optional[list] = None,
+                                             paginate: bool = False, cursor: Optional[str] = None) -> str:
                         """Execute SELECT query"""
-                        return self.tool_handler.call_tool(name, sql=sql)
+                        if sqls is not None:
+                            return await self.tool_handler.call_tool(name, sqls=sqls, format=format)
+                        return await self.tool_handler.call_tool(name, sql=sql, format=format,
+                                                                 paginate=paginate, cursor=cursor)
                     return run_query_tool
                 
                 elif name == "list_databases":
                     @self.mcp.tool(name=name, description=info["description"])
-                    def list_db_tool() -> str:
+                    async def list_db_tool() -> str:
                         """List all databases"""
-                        return self.tool_handler.call_tool(name)
+                        return await self.tool_handler.call_tool(name)
                     return list_db_tool
                 
                 elif name == "list_tables":
                     @self.mcp.tool(name=name, description=info["description"])
-                    def list_tables_tool(database: str) -> str:
+                    async def list_tables_tool(database: str) -> str:
                         """List tables in database"""
-                        return self.tool_handler.call_tool(name, database=database)
+                        return await self.tool_handler.call_tool(name, database=database)
                     return list_tables_tool
                 
                 elif name == "describe_table":
                     @self.mcp.tool(name=name, description=info["description"])
-                    def describe_table_tool(database: str, table: str) -> str:
+                    async def describe_table_tool(database: str, table: str) -> str:
                         """Describe table structure"""
-                        return self.tool_handler.call_tool(name, database=database, table=table)
+                        return await self.tool_handler.call_tool(name, database=database, table=table)
                     return describe_table_tool
                 
                 else:
                     @self.mcp.tool(name=name, description=info["description"])
-                    def standard_tool() -> str:
+                    async def standard_tool() -> str:
                         """Standard tool function"""
-                        return self.tool_handler.call_tool(name)
+                        return await self.tool_handler.call_tool(name)
                     return standard_tool
             
             create_tool_function(tool_name, input_schema, tool_info)
@@ -191,94 +204,49 @@ class SSEHandler:
         return self.sse_transport
 
 
+# Heartbeat frames differ only in the timestamp; keep the rest pre-encoded
+_HEARTBEAT_TEMPLATE = b'data: {"type":"heartbeat","timestamp":"%s"}\n\n'
+
+
 class BridgeHandler:
     """Handles bridge mode connections (HTTP + SSE)"""
     
-    def __init__(self):
-        self.tool_handler = ClickHouseToolHandler(
-            host=CLICKHOUSE_HOST,
-            username=CLICKHOUSE_USER,
-            password=CLICKHOUSE_PASSWORD,
-            port=CLICKHOUSE_PORT,
-            secure=CLICKHOUSE_SECURE
-        )
-        self.schema_manager = SchemaManager(self.tool_handler)
+    def __init__(self, tool_handler: ClickHouseToolHandler, schema_manager: SchemaManager):
+        self.tool_handler = tool_handler
+        self.schema_manager = schema_manager
         self.connections: Dict[str, bool] = {}
+        # Static JSON-RPC result payloads; only the per-request id varies
+        self._initialize_result = {
+            "protocolVersion": "2024-11-05",
+            "capabilities": {"tools": {}},
+            "serverInfo": {"name": "clickhouse-mcp-server", "version": "1.0.0"}
+        }
+        self._tools_list_result = {"tools": self.schema_manager.get_tools_list()}
+        self._empty_resources = {"resources": []}
+        self._empty_prompts = {"prompts": []}
+        # O(1) JSON-RPC method dispatch instead of sequential string compares
+        self._method_handlers = {
+            "initialize": self._handle_initialize,
+            "tools/list": self._handle_tools_list,
+            "resources/list": self._handle_resources_list,
+            "prompts/list": self._handle_prompts_list,
+            "tools/call": self._handle_tools_call,
+        }
     
-    def process_bridge_request(self, request: MCPRequest) -> Dict[str, Any]:
+    async def process_bridge_request(self, request: MCPRequest) -> Dict[str, Any]:
         """Process MCP request for bridge mode"""
         try:
             if request.id is None:
                 return {"jsonrpc": "2.0", "method": request.method, "params": request.params or {}}
             
-            if request.method == "initialize":
-                return {
-                    "jsonrpc": "2.0",
-                    "id": request.id,
-                    "result": {
-                        "protocolVersion": "2024-11-05",
-                        "capabilities": {"tools": {}},
-                        "serverInfo": {"name": "clickhouse-mcp-server", "version": "1.0.0"}
-                    }
-                }
-            
-            elif request.method == "tools/list":
-                available_tools = self.tool_handler.get_available_tools()
-                tools_list = []
-                
-                for tool_name, tool_info in available_tools.items():
-                    tool_schema = self.schema_manager.get_tool_schema(tool_name, tool_info)
-                    tools_list.append(tool_schema)
-                
-                return {
-                    "jsonrpc": "2.0",
-                    "id": request.id,
-                    "result": {"tools": tools_list}
-                }
-            
-            elif request.method == "resources/list":
-                return {"jsonrpc": "2.0", "id": request.id, "result": {"resources": []}}
-            
-            elif request.method == "prompts/list":
-                return {"jsonrpc": "2.0", "id": request.id, "result": {"prompts": []}}
-            
-            elif request.method == "tools/call":
-                tool_name = request.params.get("name")
-                arguments = request.params.get("arguments", {})
-                
-                all_tools = self.tool_handler.get_available_tools()
-                
-                if tool_name not in all_tools:
-                    return {
-                        "jsonrpc": "2.0",
-                        "id": request.id,
-                        "error": {"code": -32601, "message": f"Unknown tool: {tool_name}"}
-                    }
-                
-                validation_error = self.schema_manager.validate_tool_params(tool_name, arguments)
-                if validation_error:
-                    return {
-                        "jsonrpc": "2.0",
-                        "id": request.id,
-                        "error": {"code": -32602, "message": validation_error}
-                    }
-                
-                result = self.tool_handler.call_tool(tool_name, **arguments)
-                
-                return {
-                    "jsonrpc": "2.0",
-                    "id": request.id,
-                    "result": {
-                        "content": [{"type": "text", "text": result}]
-                    }
-                }
-            
-            else:
+            handler = self._method_handlers.get(request.method)
+            if handler is None:
                 return {
                     "jsonrpc": "2.0",
                     "id": request.id,
                     "error": {"code": -32601, "message": f"Method not found: {request.method}"}
                 }
+            return await handler(request)
         
         except Exception as e:
             logger.error(f"Error processing bridge request: {e}")
@@ -288,20 +256,65 @@ class BridgeHandler:
                 "error": {"code": -32603, "message": f"Internal error: {str(e)}"}
             }
     
+    async def _handle_initialize(self, request: MCPRequest) -> Dict[str, Any]:
+        return {"jsonrpc": "2.0", "id": request.id, "result": self._initialize_result}
+    
+    async def _handle_tools_list(self, request: MCPRequest) -> Dict[str, Any]:
+        return {"jsonrpc": "2.0", "id": request.id, "result": self._tools_list_result}
+    
+    async def _handle_resources_list(self, request: MCPRequest) -> Dict[str, Any]:
+        return {"jsonrpc": "2.0", "id": request.id, "result": self._empty_resources}
+    
+    async def _handle_prompts_list(self, request: MCPRequest) -> Dict[str, Any]:
+        return {"jsonrpc": "2.0", "id": request.id, "result": self._empty_prompts}
+    
+    async def _handle_tools_call(self, request: MCPRequest) -> Dict[str, Any]:
+        tool_name = request.params.get("name")
+        arguments = request.params.get("arguments", {})
+        
+        if tool_name not in self.tool_handler.get_available_tools():
+            return {
+                "jsonrpc": "2.0",
+                "id": request.id,
+                "error": {"code": -32601, "message": f"Unknown tool: {tool_name}"}
+            }
+        
+        validation_error = self.schema_manager.validate_tool_params(tool_name, arguments)
+        if validation_error:
+            return {
+                "jsonrpc": "2.0",
+                "id": request.id,
+                "error": {"code": -32602, "message": validation_error}
+            }
+        
+        result = await self.tool_handler.call_tool(tool_name, **arguments)
+        
+        return {
+            "jsonrpc": "2.0",
+            "id": request.id,
+            "result": {
+                "content": [{"type": "text", "text": result}]
+            }
+        }
+    
     async def create_heartbeat_stream(self, request: Request):
         """Create heartbeat stream for bridge mode"""
         connection_id = str(uuid.uuid4())
         self.connections[connection_id] = True
-        
+
         try:
-            yield f"data: {json.dumps({'type': 'connection', 'id': connection_id})}\n\n"
-            
+            yield f"data: {orjson.dumps({'type': 'connection', 'id': connection_id}).decode()}\n\n"
+
+            # Disconnects are noticed by polling once per interval (the ASGI
+            # server also cancels this generator when the client goes away);
+            # the saving here is the pre-encoded heartbeat frame
             while self.connections.get(connection_id, False):
-                yield f"data: {json.dumps({'type': 'heartbeat', 'timestamp': datetime.datetime.now().isoformat()})}\n\n"
                 await asyncio.sleep(30)
-                
+
                 if await request.is_disconnected():
                     break
+
+                yield _HEARTBEAT_TEMPLATE % datetime.datetime.now().isoformat().encode()
         except Exception as e:
             logger.error(f"Bridge connection error: {e}")
         finally:
@@ -321,16 +334,20 @@ class ClickHouseMCPServer:
             username=CLICKHOUSE_USER,
             password=CLICKHOUSE_PASSWORD,
             port=CLICKHOUSE_PORT,
-            secure=CLICKHOUSE_SECURE
+            secure=CLICKHOUSE_SECURE,
+            compress=CLICKHOUSE_COMPRESS
         )
-        self.sse_handler = SSEHandler()
-        self.bridge_handler = BridgeHandler()
+        self.schema_manager = SchemaManager(self.tool_handler)
+        self.sse_handler = SSEHandler(self.tool_handler, self.schema_manager)
+        self.bridge_handler = BridgeHandler(self.tool_handler, self.schema_manager)
         self.app = self._create_app()
     
     def _create_app(self) -> FastAPI:
         """Create and configure FastAPI application"""
-        main_app = FastAPI(title="ClickHouse MCP Server Root", version="1.0.0")
-        sub_app = FastAPI(title="ClickHouse MCP Server", version="1.0.0")
+        main_app = FastAPI(title="ClickHouse MCP Server Root", version="1.0.0",
+                           default_response_class=ORJSONResponse)
+        sub_app = FastAPI(title="ClickHouse MCP Server", version="1.0.0",
+                          default_response_class=ORJSONResponse)
         
         sub_app.add_middleware(
             CORSMiddleware,
@@ -363,6 +380,7 @@ class ClickHouseMCPServer:
                     "sse": f"{API_BASE_PATH}/sse",
                     "messages": f"{API_BASE_PATH}/messages/",
                     "message": f"{API_BASE_PATH}/message",
+                    "stream_query": f"{API_BASE_PATH}/stream_query",
                     "health": f"{API_BASE_PATH}/health"
                 },
                 "tools": available_tools,
@@ -392,18 +410,42 @@ class ClickHouseMCPServer:
         @app.post("/message")
         async def bridge_message_handler(request: Request):
             """Handle MCP messages via HTTP POST for bridge mode"""
+            raw = await request.body()
+            body = {}
             try:
-                body = await request.json()
-                mcp_request = MCPRequest(**body)
-                return self.bridge_handler.process_bridge_request(mcp_request)
+                body = orjson.loads(raw) if raw else {}
+                mcp_request = MCPRequest(
+                    jsonrpc=body.get("jsonrpc", "2.0"),
+                    method=body["method"],
+                    id=body.get("id"),
+                    params=body.get("params")
+                )
+                return await self.bridge_handler.process_bridge_request(mcp_request)
             except Exception as e:
                 logger.error(f"Bridge message error: {e}")
                 return {
                     "jsonrpc": "2.0",
-                    "id": body.get("id", "unknown") if 'body' in locals() else "unknown",
+                    "id": body.get("id", "unknown") if isinstance(body, dict) else "unknown",
                     "error": {"code": -32603, "message": f"Internal error: {str(e)}"}
                 }
         
+        @app.post("/stream_query")
+        async def stream_query(request: Request):
+            """Stream large SELECT results as newline-delimited JSON"""
+            try:
+                body = orjson.loads(await request.body())
+            except orjson.JSONDecodeError:
+                raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+            if not isinstance(body, dict):
+                raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+            sql = body.get("sql")
+            if not sql:
+                raise HTTPException(status_code=422, detail="sql is required")
+            return StreamingResponse(
+                self.tool_handler.run_query.execute_stream(sql),
+                media_type="application/x-ndjson"
+            )
+        
         @app.get("/health")
         async def health_check():
             """Health check endpoint"""
@@ -447,7 +489,17 @@ class ClickHouseMCPServer:
         else:
             print(" Database connection failed - check credentials")
         
-        uvicorn.run(self.app, host=run_host, port=run_port, log_level="info")
+        # uvicorn refuses workers > 1 when handed an app object rather than an
+        # import string, so this server runs single-worker; scale horizontally
+        # by running multiple processes behind a load balancer instead
+        uvicorn.run(
+            self.app,
+            host=run_host,
+            port=run_port,
+            log_level="info",
+            loop="uvloop",
+            http="httptools"
+        )
 
 
 if __name__ == "__main__":